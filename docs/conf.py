@@ -9,6 +9,8 @@
 # list, refer to https://www.sphinx-doc.org/en/master/usage/configuration.html
 # =============================================================================
 
+import os
+
 project = 'Handprint'
 copyright = '2022, Caltech Library'
 author = 'Michael Hucka @ Caltech Library'
@@ -21,9 +23,13 @@ extensions = [
     'sphinx.ext.autodoc',
     'sphinx.ext.autosectionlabel',
     'sphinx.ext.napoleon',
-    'sphinxcontrib.mermaid'
 ]
 
+# Loading the Mermaid extension is slow.  Setting HANDPRINT_DOCS_FAST in the
+# environment skips it, to speed up rebuilds while editing the docs locally.
+if not os.environ.get('HANDPRINT_DOCS_FAST'):
+    extensions.append('sphinxcontrib.mermaid')
+
 # Add any paths that contain templates here, relative to this directory.
 templates_path = ['_templates']
 
@@ -42,16 +42,8 @@ if sys.version_info <= (3, 8):
           str(sys.version_info.major) + '.' + str(sys.version_info.minor) + '.')
     exit(6)
 
-from   boltons.debugutils import pdb_on_signal
-from   bun import UI, inform, alert, alert_fatal, warn
-from   commonpy.data_utils import timestamp
-from   commonpy.file_utils import filename_extension, files_in_directory
-from   commonpy.file_utils import readable, writable
-from   commonpy.interrupt import config_interrupt, interrupt, interrupted
-from   commonpy.string_utils import antiformat
-from   fastnumbers import fast_real, isreal, isint
 import os
-from   os import path, cpu_count
+from   os import path
 import plac
 import signal
 
@@ -60,12 +52,23 @@ if __debug__:
 
 import handprint
 from handprint import print_version
-from handprint.credentials import Credentials
-from handprint.exceptions import *
+from handprint.exceptions import CannotProceed, UserCancelled
 from handprint.exit_codes import ExitCode
-from handprint.main_body import MainBody
 from handprint.services import services_list
 
+
+# Internal constants.
+# .............................................................................
+
+# Neither of these change while the program runs.
+_KNOWN_SERVICES = frozenset(services_list())
+_PREFIX = '/' if sys.platform.startswith('win') else '-'
+
+# Values accepted by option -d.
+_POSSIBLE_DISPLAYS = frozenset(['text', 'bb', 'bb-word', 'bb-words', 'bb-line',
+                                'bb-lines', 'bb-para', 'bb-paragraph',
+                                'bb-paragraphs'])
+
 
 # Main program.
 # .............................................................................
@@ -80,6 +83,8 @@ from handprint.services import services_list
     from_file  = ('read list of images or URLs from file "F"',             'option', 'f'),
     no_grid    = ('do not create an all-results grid image',               'flag',   'G'),
     reuse_json = ('look for prior JSON results for the inputs & use them', 'flag',   'j'),
+    no_cache   = ('do not use or update the cache of service results',     'flag',   'K'),
+    cache_dir  = ('keep cached service results in directory "K"',          'option', 'k'),
     list       = ('print list of known services',                          'flag',   'l'),
     text_move  = ('move position of text annotations by x,y (see help)',   'option', 'm'),
     confidence = ('only keep results with confidence scores >= N',         'option', 'n'),
@@ -87,9 +92,10 @@ from handprint.services import services_list
     quiet      = ('only print important messages while working',           'flag',   'q'),
     relaxed    = ('make --compare use more relaxed criteria',              'flag',   'r'),
     services   = ('invoke HTR/OCR service "S" (default: "all")',           'option', 's'),
-    threads    = ('number of threads to use (default: #cores/2)',          'option', 't'),
+    threads    = ('number of threads to use (default: 1 per service)',     'option', 't'),
     version    = ('print version info and exit',                           'flag',   'V'),
     text_color = ('use color "X" for text annotations (default: red)',     'option', 'x'),
+    wipe_cache = ('delete all cached service results and exit',            'flag',   'X'),
     text_size  = ('use font size "Z" for text annotations (default: 10)',  'option', 'z'),
     debug      = ('write detailed trace to "OUT" ("-" means console)',     'option', '@'),
     files      = 'file(s), directory(ies) of files, or URL(s)',
@@ -97,10 +103,11 @@ from handprint.services import services_list
 
 def main(add_creds = 'A', base_name = 'B', no_color = False, compare = False,
          display = 'D', extended = False, from_file = 'F', no_grid = False,
-         list = False, reuse_json = False, text_move = 'M', confidence = 'N',
-         output_dir = 'O', quiet = False, relaxed = False, services = 'S',
-         threads = 'T', version = False, text_color = 'X', text_size = 'Z',
-         debug = 'OUT', *files):
+         list = False, reuse_json = False, no_cache = False, cache_dir = 'K',
+         text_move = 'M', confidence = 'N', output_dir = 'O', quiet = False,
+         relaxed = False, services = 'S', threads = 'T', version = False,
+         text_color = 'X', wipe_cache = False, text_size = 'Z', debug = 'OUT',
+         *files):
     '''Handprint (a loose acronym of "HANDwritten Page RecognitIoN Test") runs
 alternative text recognition services on images of handwritten document pages.
 
@@ -161,10 +168,12 @@ directory if option -o is not used.
 No matter whether files or URLs, each input should be a single image of a
 document page in which text should be recognized.  Handprint can accept input
 images in JP2, JPEG, PDF, PNG, GIF, BMP, and TIFF formats. To make the
-results from different services more easily comparable, Handprint will always
-convert all input images to the same format (PNG) no matter if some services
-may accept other formats; it will also downsize input images to the smallest
-size accepted by any of the services invoked if an image exceeds that size.
+results from different services more easily comparable, Handprint sends the
+same image to every service: if the input is in a format that all of the
+services invoked accept (e.g., JPEG or PNG), it is sent as-is; otherwise,
+it is converted to PNG.  Handprint will also downsize input images to the
+smallest size accepted by any of the services invoked if an image exceeds
+that size.
 (For example, if service A accepts files up to 10 MB in size and service B
 accepts files up to 4 MB, all input images will be resized to 4 MB before
 sending them to both A and B, even if A could accept a higher- resolution
@@ -341,7 +350,7 @@ Handprint attempts to cope with possibly-missing text in the HTR results by
 matching up likely corresponding lines in the expected and received results.
 It does this by comparing each line of ground-truth text to each line of the
 HTR results using longest common subsequence similarity, as implemented by
-the LCSSEQ function in the Python "textdistance" package.  If the lines do
+the LCSseq functions in the Python "rapidfuzz" package.  If the lines do
 not pass a threshold score, Handprint looks at subsequent lines of the HTR
 results and tries to reestablish correspondence to ground truth.  If nothing
 else in the HTR results appear close enough to the expected ground-truth
@@ -364,6 +373,17 @@ and use those instead of getting results from the services.  This can be useful
 to save repeated invocations of the services if all you want is to draw the
 results differently or perform some testing/debugging on the same inputs.
 
+Handprint keeps a cache of the results returned by the services, indexed by
+the content of the (normalized) images sent to them, so that running Handprint
+again on the same images does not contact the services again.  The cache is
+stored in a directory specific to the user account, such as ~/.cache/Handprint
+on Linux or ~/Library/Caches/Handprint on macOS; the option -k (/k on Windows)
+can be used to name a different directory, for example to share one cache
+between several accounts.  Cached results are used for up to one week, after
+which the services are contacted again.  The option -K (/K on Windows) tells
+Handprint to neither use nor update the cache during a run, and the option -X
+(/X on Windows) tells Handprint to delete the cache and exit.
+
 To move the position of the text annotations overlayed over the input image,
 you can use the option -m (or /m on Windows).  This takes two numbers separated
 by a comma in the form x,y.  Positive numbers move the text rightward and
@@ -384,11 +404,11 @@ To change the size of the text annotations overlayed over the input image,
 you can use the option -z (or /z on Windows).  The value is in units of points.
 The default size is 12 points.
 
-Handprint will send files to the different services in parallel, using a
-number of process threads at most equal to 1/2 of the number of cores on the
-computer it is running on.  (E.g., if your computer has 4 cores, it will by
-default use at most 2 threads.)  The option -t (/t on Windows) can be used to
-change this number.
+Handprint will send files to the different services in parallel, using one
+thread per service.  The threads spend nearly all their time waiting for the
+services to respond, so this does not depend on the number of cores on the
+computer.  The option -t (/t on Windows) can be used to change this number;
+in particular, -t 1 makes Handprint contact the services one at a time.
 
 If given the -q option (/q on Windows), Handprint will not print its usual
 informational messages while it is working.  It will only print messages
@@ -431,11 +451,28 @@ Command-line arguments summary
 
     # Initial setup -----------------------------------------------------------
 
-    pref = '/' if sys.platform.startswith('win') else '-'
-    hint = f'(Hint: use {pref}h for help.)'
+    # Handle these before creating the UI, which they don't need.
+    if version:
+        print_version()
+        exit(int(ExitCode.success))
+    if list:
+        print('Known services: ' + ', '.join(services_list()))
+        exit(int(ExitCode.success))
+
+    # The rest needs these, which take a while to load (Bun loads Rich).
+    from bun import UI, inform, alert, alert_fatal, warn
+    from commonpy.data_utils import timestamp
+    from commonpy.file_utils import readable
+    from commonpy.interrupt import config_interrupt
+    from commonpy.string_utils import antiformat
+
+    hint = f'(Hint: use {_PREFIX}h for help.)'
+    # The banner is only useful to people watching the terminal.  (Rich
+    # already leaves out color codes when the output is not a terminal.)
     ui = UI('Handprint', 'HANDwritten Page RecognitIoN Test',
             use_color = not no_color, be_quiet = quiet,
-            show_banner = not (version or list or add_creds != 'A'))
+            show_banner = (add_creds == 'A' and not wipe_cache
+                           and sys.stdout.isatty()))
     ui.start()
 
     if debug != 'OUT':
@@ -444,44 +481,48 @@ Command-line arguments summary
         faulthandler.enable()
         if not sys.platform.startswith('win'):
             # Even with a different signal, I can't get this to work on Win.
+            from boltons.debugutils import pdb_on_signal
             pdb_on_signal(signal.SIGUSR1)
 
     # Preprocess arguments and handle early exits -----------------------------
 
-    if version:
-        print_version()
-        exit(int(ExitCode.success))
-    if list:
-        inform('Known services: [bold]{}[/]', ', '.join(services_list()))
-        exit(int(ExitCode.success))
     if add_creds != 'A':
         service = add_creds.lower()
-        if service not in services_list():
+        if service not in _KNOWN_SERVICES:
             alert(f'Unknown service: "{service}". {hint}')
             exit(int(ExitCode.bad_arg))
         if not files or len(files) > 1:
-            alert(f'Option {pref}a requires one file. {hint}')
+            alert(f'Option {_PREFIX}a requires one file. {hint}')
             exit(int(ExitCode.bad_arg))
         creds_file = files[0]
         if not readable(creds_file):
             alert(f'File not readable: {creds_file}')
             exit(int(ExitCode.file_error))
+        from handprint.credentials import Credentials
         Credentials.save_credentials(service, creds_file)
         inform(f'Saved credentials for service "{service}".')
         exit(int(ExitCode.success))
+    cache_dir = None if cache_dir == 'K' else cache_dir
+    if cache_dir and path.exists(cache_dir) and not path.isdir(cache_dir):
+        alert_fatal(f'Option {_PREFIX}k requires a directory: {cache_dir}')
+        exit(int(ExitCode.bad_arg))
+    if wipe_cache:
+        from handprint.cache import ResultCache
+        ResultCache(cache_dir).clear()
+        inform('Deleted cached service results.')
+        exit(int(ExitCode.success))
     services = services_list() if services == 'S' else services.lower().split(',')
-    if services != 'S' and not all(s in services_list() for s in services):
-        alert_fatal(f'"{services}" is/are not known services. {hint}')
+    unknown = set(services) - _KNOWN_SERVICES
+    if unknown:
+        alert_fatal(f'Unknown service(s): {", ".join(sorted(unknown))}. {hint}')
         exit(int(ExitCode.bad_arg))
     display_given = display
     display = ['text'] if display == 'D' else display.lower().split(',')
-    possible_displays = ['text', 'bb', 'bb-word', 'bb-words', 'bb-line',
-                         'bb-lines', 'bb-para', 'bb-paragraph', 'bb-paragraphs']
-    if not all(d in possible_displays for d in display):
-        alert_fatal(f'Unrecognized value for {pref}d: {display_given}. {hint}')
+    if not _POSSIBLE_DISPLAYS.issuperset(display):
+        alert_fatal(f'Unrecognized value for {_PREFIX}d: {display_given}. {hint}')
         exit(int(ExitCode.bad_arg))
     if no_grid and not extended and not compare:
-        alert_fatal(f'{pref}G without {pref}e or {pref}c produces no output. {hint}')
+        alert_fatal(f'{_PREFIX}G without {_PREFIX}e or {_PREFIX}c produces no output. {hint}')
         exit(int(ExitCode.bad_arg))
     if any(item.startswith('-') for item in files):
         bad = next(item for item in files if item.startswith('-'))
@@ -491,20 +532,30 @@ Command-line arguments summary
         alert_fatal(f'Need images or URLs to have something to do. {hint}')
         exit(int(ExitCode.bad_arg))
     if relaxed and not compare:
-        warn(f'Option {pref}r without {pref}c has no effect. {hint}')
-    if text_move != 'M' and ',' not in text_move:
-        alert_fatal(f'Option {pref}m requires an argument of the form x,y. {hint}')
-        exit(int(ExitCode.bad_arg))
-    if text_size != 'Z' and not isint(text_size):
-        alert_fatal(f'Option {pref}z requires an integer as an argument. {hint}')
-        exit(int(ExitCode.bad_arg))
+        warn(f'Option {_PREFIX}r without {_PREFIX}c has no effect. {hint}')
+    if cache_dir and no_cache:
+        warn(f'Option {_PREFIX}k with {_PREFIX}K has no effect. {hint}')
+    if text_move != 'M':
+        try:
+            (x_shift, y_shift) = text_move.strip('()" \\').split(',')
+            text_move = (int(x_shift), int(y_shift))
+        except ValueError:
+            alert_fatal(f'Option {_PREFIX}m requires an argument of the form x,y. {hint}')
+            exit(int(ExitCode.bad_arg))
+    if text_size != 'Z':
+        try:
+            text_size = int(text_size)
+        except ValueError:
+            alert_fatal(f'Option {_PREFIX}z requires an integer as an argument. {hint}')
+            exit(int(ExitCode.bad_arg))
     if confidence != 'N':
-        if not isreal(confidence):
-            alert_fatal(f'Option {pref}n requires a real number as an argument. {hint}')
+        try:
+            confidence = float(confidence)
+        except ValueError:
+            alert_fatal(f'Option {_PREFIX}n requires a real number as an argument. {hint}')
             exit(int(ExitCode.bad_arg))
-        confidence = fast_real(confidence)
         if not (0 <= confidence <= 1.0):
-            alert_fatal(f'Option {pref}n requires a real number between 0 and 1.0. {hint}')
+            alert_fatal(f'Option {_PREFIX}n requires a real number between 0 and 1.0. {hint}')
             exit(int(ExitCode.bad_arg))
 
     # Do the real work --------------------------------------------------------
@@ -512,6 +563,7 @@ Command-line arguments summary
     if __debug__: log('='*8 + f' started {timestamp()} ' + '='*8)
     body = exception = None
     try:
+        from handprint.main_body import MainBody
         body = MainBody(files      = files,
                         from_file  = None if from_file == 'F' else from_file,
                         output_dir = None if output_dir == 'O' else output_dir,
@@ -519,14 +571,16 @@ Command-line arguments summary
                         base_name  = 'document' if base_name == 'B' else base_name,
                         confidence = 0 if confidence == 'N' else confidence,
                         text_color = 'red' if text_color == 'X' else text_color.lower(),
-                        text_shift = '0,0' if text_move == 'M' else text_move,
+                        text_shift = (0, 0) if text_move == 'M' else text_move,
                         text_size  = '12' if text_size == 'Z' else int(text_size),
                         display    = display,
                         make_grid  = not no_grid,
                         extended   = extended,
                         reuse_json = reuse_json,
+                        use_cache  = not no_cache,
+                        cache_dir  = cache_dir,
                         services   = services,
-                        threads    = max(1, cpu_count()//2 if threads == 'T' else int(threads)),
+                        threads    = len(services) if threads == 'T' else max(1, int(threads)),
                         compare    = 'relaxed' if (compare and relaxed) else compare)
         config_interrupt(body.stop, UserCancelled(ExitCode.user_interrupt))
         body.run()
@@ -566,6 +620,10 @@ Command-line arguments summary
     if exit_code == ExitCode.user_interrupt:
         # This is a sledgehammer, but it kills everything, including ongoing
         # network get/post. I have not found a more reliable way to interrupt.
+        # os._exit() skips the normal interpreter cleanup, so flush our output
+        # first or the last messages are lost when it's redirected to a file.
+        sys.stdout.flush()
+        sys.stderr.flush()
         os._exit(int(exit_code))
     else:
         exit(int(exit_code))
@@ -0,0 +1,170 @@
+'''
+cache.py: disk cache of results returned by services
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2018-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   appdirs import user_cache_dir
+import json
+import os
+from   os import path, makedirs
+import re
+import tempfile
+from   time import time
+
+if __debug__:
+    from sidetrack import log
+
+# BLAKE3 is several times faster than SHA-256 on large images, but it's an
+# optional dependency.  The name of the algorithm is part of the cache key so
+# that entries created with one are never confused with the other.
+try:
+    from blake3 import blake3 as _hasher
+    _HASH_NAME = 'blake3'
+except ImportError:
+    from hashlib import sha256 as _hasher
+    _HASH_NAME = 'sha256'
+
+# Images are hashed in blocks of this many bytes, rather than being read into
+# memory all at once.
+_BLOCK_SIZE = 1024*1024
+
+# Names of the files holding cache entries.  Only these are ever deleted.
+_ENTRY_NAME = re.compile(r'(blake3|sha256)-[0-9a-f]+\.json')
+
+# Services evolve, and results from the same image can change over time.
+# Cached results older than this (in seconds) are ignored and deleted.
+_MAX_AGE = 7*24*60*60
+
+
+# Main class.
+# .............................................................................
+
+class ResultCache(object):
+    '''Cache of the raw data returned by services, stored on disk.
+
+    Results are stored as JSON files (the same data that the -e option saves)
+    and indexed by the name of the service and a hash (BLAKE3 if available,
+    else SHA-256) of the content of the image that was sent to the service.
+    Because the images are normalized before they are sent, the same input
+    image processed with the same set of services produces the same key in
+    subsequent runs.  Entries expire after "max_age" seconds (default: 1 week).
+    '''
+
+    cache_dir = user_cache_dir('Handprint', 'CaltechLibrary')
+
+    def __init__(self, cache_dir = None, max_age = _MAX_AGE):
+        if cache_dir:
+            self.cache_dir = cache_dir
+        self.max_age = max_age
+
+
+    def digest(self, file):
+        '''Return the hash of the content of "file" used in cache keys.'''
+        hasher = _hasher()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+                hasher.update(block)
+        return f'{_HASH_NAME}-{hasher.hexdigest()}'
+
+
+    def key(self, file, service_name, digest = None):
+        '''Return the cache key for results from "service_name" on "file".
+        If the value of digest(file) is already known, it can be passed as
+        "digest" to avoid reading the file again.'''
+        if not digest:
+            digest = self.digest(file)
+        return f'{service_name}:{digest}'
+
+
+    def get(self, key):
+        '''Return the data stored under "key", or None if there is none.'''
+        cached_file = self._path(key)
+        if not path.exists(cached_file):
+            return None
+        try:
+            if time() - path.getmtime(cached_file) > self.max_age:
+                if __debug__: log(f'deleting expired cache file {cached_file}')
+                os.unlink(cached_file)
+                return None
+            with open(cached_file, 'r') as f:
+                if __debug__: log(f'reading cached result from {cached_file}')
+                return json.load(f)
+        except (OSError, ValueError) as ex:
+            # A damaged entry is no worse than a missing one.
+            if __debug__: log(f'ignoring unreadable cache file {cached_file}: {ex}')
+            return None
+
+
+    def set(self, key, data):
+        '''Store "data" under "key".  The data must be serializable as JSON.
+        Returns False if the data could not be written (e.g., because the
+        cache directory is not writable or the disk is full).
+        '''
+        cached_file = self._path(key)
+        cached_dir = path.dirname(cached_file)
+        tmp_file = None
+        try:
+            if not path.isdir(cached_dir):
+                makedirs(cached_dir, exist_ok = True)
+            # Write to a temporary file first, so that an interrupted write or
+            # another process reading at the same time never sees a partial file.
+            (fd, tmp_file) = tempfile.mkstemp(dir = cached_dir, suffix = '.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, cached_file)
+            if __debug__: log(f'cached result in {cached_file}')
+            return True
+        except OSError as ex:
+            # Failing to cache a result is no reason to stop.
+            if __debug__: log(f'unable to write cache file {cached_file}: {ex}')
+            self._remove(tmp_file)
+            return False
+        except:
+            self._remove(tmp_file)
+            raise
+
+
+    def clear(self):
+        '''Delete all cached results.'''
+        # The cache directory can be set by the user, so don't assume that
+        # everything in it belongs to the cache.
+        if not path.isdir(self.cache_dir):
+            return
+        if __debug__: log(f'deleting cached results in {self.cache_dir}')
+        with os.scandir(self.cache_dir) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir(follow_symlinks = False):
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    for entry in entries:
+                        if _ENTRY_NAME.fullmatch(entry.name):
+                            os.unlink(entry.path)
+                try:
+                    os.rmdir(subdir.path)
+                except OSError:
+                    # Not empty, so it holds something other than results.
+                    pass
+
+
+    def _remove(self, tmp_file):
+        try:
+            if tmp_file and path.exists(tmp_file):
+                os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
+    def _path(self, key):
+        (service_name, digest) = key.split(':', 1)
+        return path.join(self.cache_dir, service_name, digest + '.json')
@@ -52,8 +52,8 @@ def text_comparison(htr_text, gt_text, relaxed = False):
     contain a line of text for every line of ground truth, and conversely,
     may also contain lines of text that are not supposed to appear.  The
     approach uses a novel algorithm to compare the texts line-by-line using
-    longest common subsequence similarity (as implemented by the LCSSEQ
-    function in the Python "textdistance" package), to try to match up
+    longest common subsequence similarity (as implemented by the LCSseq
+    functions in the Python "rapidfuzz" package), to try to match up
     corresponding lines in the two texts before calculating Levenshtein
     distance and CER for each line individually.
     '''
@@ -101,11 +101,10 @@ def text_comparison(htr_text, gt_text, relaxed = False):
     # 4) Go through the list of tuples, add up error scores and other things
     #    and produce the final output string.
 
-    # Textdistance takes a long time to load.  Delay loading it until we need
-    # it so that the overall application startup times can be faster.
-    from textdistance import lcsseq
-    # Shorten this name for easier reading in the code below.
-    lcsseq_score = lcsseq.normalized_similarity
+    # Delay loading rapidfuzz until we need it so that the overall
+    # application startup times can be faster.
+    from rapidfuzz.distance import LCSseq
+    from rapidfuzz.process import cdist
 
     gt_lines  = gt_text.strip().splitlines()
     htr_lines = htr_text.strip().splitlines()
@@ -113,14 +112,17 @@ def text_comparison(htr_text, gt_text, relaxed = False):
     results   = []
 
     if relaxed:
-        gt_lines  = [text.lower() for text in gt_lines]
-        gt_lines  = [text.translate(_PUNCTUATION_REMOVER) for text in gt_lines]
-        htr_lines = [text.lower() for text in htr_lines]
-        htr_lines = [text.translate(_PUNCTUATION_REMOVER) for text in htr_lines]
+        gt_lines  = [text.lower().translate(_PUNCTUATION_REMOVER) for text in gt_lines]
+        htr_lines = [text.lower().translate(_PUNCTUATION_REMOVER) for text in htr_lines]
 
-    for gt_line in gt_lines:
+    # Compute the LCSSEQ scores of every gt line against every htr line in
+    # one call.  This is much faster than computing them one pair at a time
+    # in the loop below, even though not all of them end up being used.
+    scores = cdist(gt_lines, htr_lines, scorer = LCSseq.normalized_similarity)
+
+    for gt_index, gt_line in enumerate(gt_lines):
         htr_line = htr_lines[htr_index]
-        if lcsseq_score(gt_line, htr_line) >= _SIMILARITY_THRESHOLD:
+        if scores[gt_index, htr_index] >= _SIMILARITY_THRESHOLD:
             results.append(line_data(gt_line, htr_line, htr_index))
             htr_index += 1
         else:
@@ -128,7 +130,7 @@ def text_comparison(htr_text, gt_text, relaxed = False):
             # line in the HTR text is something not found in the gt text.
             # Check if any line later in the HTR text matches any better.
             for other_index, other_line in enumerate(htr_lines[htr_index + 1:], 1):
-                if lcsseq_score(gt_line, other_line) >= _SIMILARITY_THRESHOLD:
+                if scores[gt_index, htr_index + other_index] >= _SIMILARITY_THRESHOLD:
                     # We found a matching line.
                     htr_index += other_index
                     results.append(line_data(gt_line, other_line, htr_index))
@@ -176,11 +178,11 @@ def line_data(gt_line, htr_line, htr_index):
     # Remove leading spaces and compress runs of spaces in the line.
     expected = ' '.join(gt_line.split())
     obtained = ' '.join(htr_line.split())
-    # The stringdist package definition of levenshtein_norm() divides
+    # The rapidfuzz definition of Levenshtein.normalized_distance() divides
     # by the longest of the two strings, but it is more conventional in
     # OCR papers and software to divide by the length of the reference.
-    from stringdist import levenshtein
-    distance = levenshtein(expected, obtained)
+    from rapidfuzz.distance import Levenshtein
+    distance = Levenshtein.distance(expected, obtained)
     if len(expected) > 0:
         cer = '{:.2f}'.format(100 * float(distance)/len(expected))
     else:
@@ -0,0 +1,70 @@
+'''
+cpus.py: find out how many CPUs Handprint can actually use
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2018-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import math
+import os
+
+if __debug__:
+    from sidetrack import log
+
+
+# Main functions.
+# .............................................................................
+
+def available_cpus():
+    '''Return the number of CPUs this process may run on.
+
+    os.cpu_count() reports all the CPUs in the computer, but the process may
+    be restricted to fewer by CPU affinity settings or (in containers) by a
+    cgroup CPU quota.  This takes both into account where the operating
+    system supports them.  The result is always at least 1.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        count = len(os.sched_getaffinity(0))
+    else:
+        count = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota:
+        count = min(count, quota)
+    if __debug__: log(f'available CPUs = {count}')
+    return max(1, count)
+
+
+# Helper functions.
+# .............................................................................
+
+def _cgroup_cpu_quota():
+    '''Return the CPU limit imposed by a cgroup, rounded up, or None.'''
+    # cgroup v2: a single file containing "max PERIOD" or "QUOTA PERIOD".
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            (quota, period) = f.read().split()[:2]
+        if quota != 'max':
+            return math.ceil(int(quota)/int(period))
+        return None
+    except (OSError, ValueError):
+        pass
+    # cgroup v1: separate files; a quota of -1 means no limit.
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return math.ceil(quota/period)
+    except (OSError, ValueError):
+        pass
+    return None
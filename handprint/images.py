@@ -17,9 +17,7 @@ file "LICENSE" for more information.
 from   boltons.iterutils import flatten
 from   commonpy.file_utils import relative, readable
 from   commonpy.file_utils import filename_extension, filename_basename
-import io
 import matplotlib
-import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 from   matplotlib.patches import Polygon
 
@@ -97,6 +95,13 @@ _Z_ORDER = {'word': 3,
             'line': 2,
             'para': 1}
 
+# When downscaling by a large factor, Pillow can first shrink the image by an
+# integer factor using fast block averaging (Image.reduce) and only apply the
+# resampling filter to the remaining factor.  This value tells resize() how
+# close to the final size that first step may get; 3 gives results that are
+# indistinguishable from a full resampling at a fraction of the cost.
+_REDUCING_GAP = 3.0
+
 
 # Main functions.
 # .............................................................................
@@ -136,6 +141,19 @@ def image_dimensions(file):
         return the_size
 
 
+def exif_rotated(file):
+    '''Returns True if the image has an EXIF orientation other than normal.'''
+    # Some services apply the EXIF orientation before recognizing text, and
+    # then the coordinates they return don't match the pixels as stored.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            with Image.open(file) as im:
+                return im.getexif().get(0x0112, 1) != 1
+        except Exception:
+            return False
+
+
 def reduced_image_size(orig_file, dest_file, max_size):
     '''Resizes the image and writes a new file named "ORIGINAL-reduced.EXT".
     Returns a tuple of (new_file, error).  The value of 'error' will be None
@@ -156,7 +174,7 @@ def reduced_image_size(orig_file, dest_file, max_size):
             dims = im.size
             new_dims = (round(dims[0] * ratio), round(dims[1] * ratio))
             if __debug__: log(f'resizing image to {new_dims}')
-            resized = im.resize(new_dims, Image.HAMMING)
+            resized = _resized(im, new_dims)
             if __debug__: log(f'saving resized image to {relative(dest_file)}')
             if orig_file == dest_file:
                 im.seek(0)
@@ -184,7 +202,7 @@ def reduced_image_dimensions(orig_file, dest_file, max_width, max_height):
             if __debug__: log(f'rescale ratio = {ratio}')
             new_dims = (round(dims[0] * ratio), round(dims[1] * ratio))
             if __debug__: log(f'rescaling image to {new_dims}')
-            resized = im.resize(new_dims, Image.HAMMING)
+            resized = _resized(im, new_dims)
             if __debug__: log(f'saving re-dimensioned image to {relative(dest_file)}')
             if orig_file == dest_file:
                 im.seek(0)
@@ -194,8 +212,11 @@ def reduced_image_dimensions(orig_file, dest_file, max_width, max_height):
             return (None, str(ex))
 
 
-def converted_image(orig_file, to_format, dest_file = None):
+def converted_image(orig_file, to_format, dest_file = None, max_dimensions = None):
     '''Convert image in "orig_file" to format "to_format".
+    If "max_dimensions" is given as a tuple (max_width, max_height), images
+    larger than that are also scaled down as part of the conversion, so that
+    the image does not have to be decoded and encoded a second time.
     Returns a tuple of (new_file, error).  The value of 'error' will be None
     if no error occurred; otherwise, the value will be a string summarizing the
     error that occurred and 'new_file' will be set to None.
@@ -229,6 +250,14 @@ def converted_image(orig_file, to_format, dest_file = None):
             warnings.simplefilter('ignore')
             try:
                 im = Image.open(orig_file)
+                if max_dimensions:
+                    (max_width, max_height) = max_dimensions
+                    dims = im.size
+                    ratio = min(max_width/dims[0], max_height/dims[1])
+                    if ratio < 1:
+                        new_dims = (round(dims[0] * ratio), round(dims[1] * ratio))
+                        if __debug__: log(f'rescaling image to {new_dims}')
+                        im = _resized(im, new_dims)
                 if __debug__: log(f'converting {relative(orig_file)} to RGB')
                 im.convert('RGB')
                 if __debug__: log(f'saving converted image to {relative(dest_file)}')
@@ -240,8 +269,9 @@ def converted_image(orig_file, to_format, dest_file = None):
                 return (None, str(ex))
 
 
-def annotated_image(file, boxes, service, size = 12, color = 'r', shift = '0,0',
-                    display = ['text'], score_threshold = 0):
+def annotated_image(file, boxes, service, dest_file, size = 12, color = 'r',
+                    shift = (0, 0), display = ['text'], score_threshold = 0):
+    '''Write a PNG version of "file" annotated with "boxes" to "dest_file".'''
     service_name = service.name().title()
 
     fig, axes = plt.subplots(nrows = 1, ncols = 1, figsize = (20, 20))
@@ -250,7 +280,17 @@ def annotated_image(file, boxes, service, size = 12, color = 'r', shift = '0,0',
     axes.set_title(service_name, color = color, fontweight = 'bold', fontsize = 20)
 
     if __debug__: log(f'reading image file for {service_name}: {relative(file)}')
-    img = mpimg.imread(file)
+    # matplotlib's imread returns PNG pixels as float32 values, which takes 4
+    # times the memory of the 8-bit values that imshow() accepts just as well.
+    with Image.open(file) as im:
+        if im.mode == 'I' or im.mode.startswith('I;16'):
+            # 16-bit grayscale, common in archival scans.  Scale it to 8 bits;
+            # converting it to RGB would clip all values above 255 instead.
+            img = (np.clip(np.asarray(im), 0, 65535) >> 8).astype(np.uint8)
+        else:
+            if im.mode not in ('L', 'RGB', 'RGBA'):
+                im = im.convert('RGB')
+            img = np.asarray(im)
     axes.imshow(img, cmap = "gray")
 
     boxes = [item for item in boxes if item.score >= score_threshold]
@@ -272,14 +312,7 @@ def annotated_image(file, boxes, service, size = 12, color = 'r', shift = '0,0',
             axes.add_patch(poly)
 
     if boxes and any(d == 'text' for d in display):
-        x_shift, y_shift = 0, 0
-        shift = shift.strip('()" \\\\').split(',')
-        if len(shift) == 2:
-            try:
-                x_shift, y_shift = int(shift[0]), int(shift[1])
-            except ValueError:
-                pass
-
+        (x_shift, y_shift) = shift
         props = {'facecolor': 'white', 'edgecolor': 'none', 'alpha': 0.8, 'pad': 1}
         for box in filter(lambda item: item.kind == 'word', boxes):
             x = max(0, box.bb[0] + x_shift)
@@ -287,14 +320,12 @@ def annotated_image(file, boxes, service, size = 12, color = 'r', shift = '0,0',
             plt.text(x, y, box.text, color = color, fontsize = size,
                      va = "center", bbox = props, zorder = 10)
 
-    if __debug__: log(f'generating png for {service_name} for {relative(file)}')
-    buf = io.BytesIO()
-    fig.savefig(buf, format = 'png', dpi = 300, bbox_inches = 'tight', pad_inches = 0.02)
-    buf.flush()
-    buf.seek(0)
-    plt.close(fig)
-
-    return buf
+    if __debug__: log(f'writing png for {service_name} to {relative(dest_file)}')
+    try:
+        fig.savefig(dest_file, format = 'png', dpi = 300, bbox_inches = 'tight',
+                    pad_inches = 0.02)
+    finally:
+        plt.close(fig)
 
 
 # This function was originally based on code posted by user "Maxim" to
@@ -306,14 +337,35 @@ def create_image_grid(image_files, dest_file, max_horizontal = np.iinfo(int).max
     n_horiz = min(n_images, max_horizontal)
     h_sizes = [0] * n_horiz
     v_sizes = [0] * ((n_images // n_horiz) + (1 if n_images % n_horiz > 0 else 0))
+    # Image.open() only reads the file headers, so getting the sizes is cheap.
+    # Each image is decoded when it's pasted and closed right after, so that
+    # only one of them is held in memory at a time besides the grid itself.
     images = [Image.open(f) for f in image_files]
-    for i, im in enumerate(images):
-        h, v = i % n_horiz, i // n_horiz
-        h_sizes[h] = max(h_sizes[h], im.size[0])
-        v_sizes[v] = max(v_sizes[v], im.size[1])
-    h_sizes, v_sizes = np.cumsum([0] + h_sizes), np.cumsum([0] + v_sizes)
-    im_grid = Image.new('RGB', (h_sizes[-1], v_sizes[-1]), color = 'white')
-    for i, im in enumerate(images):
-        im_grid.paste(im, (h_sizes[i % n_horiz], v_sizes[i // n_horiz]))
+    try:
+        for i, im in enumerate(images):
+            h, v = i % n_horiz, i // n_horiz
+            h_sizes[h] = max(h_sizes[h], im.size[0])
+            v_sizes[v] = max(v_sizes[v], im.size[1])
+        h_sizes, v_sizes = np.cumsum([0] + h_sizes), np.cumsum([0] + v_sizes)
+        im_grid = Image.new('RGB', (h_sizes[-1], v_sizes[-1]), color = 'white')
+        for i, im in enumerate(images):
+            im_grid.paste(im, (h_sizes[i % n_horiz], v_sizes[i // n_horiz]))
+            im.close()
+    finally:
+        for im in images:
+            im.close()
     im_grid.save(dest_file)
     return im_grid
+
+
+# Helper functions.
+# .............................................................................
+
+def _resized(im, new_dims):
+    '''Return a copy of Image "im" scaled to "new_dims".'''
+    # For JPEG images, draft() makes the decoder itself scale the image down
+    # by a factor of 2, 4 or 8 while reading it, as long as the result is not
+    # smaller than new_dims.  That's much faster than decoding the image at
+    # full size first.  For other formats, it does nothing.
+    im.draft(im.mode, new_dims)
+    return im.resize(new_dims, Image.HAMMING, reducing_gap = _REDUCING_GAP)
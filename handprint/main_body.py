@@ -18,7 +18,7 @@ from   bun import inform, alert, alert_fatal, warn
 from   commonpy.interrupt import raise_for_interrupts
 from   commonpy.data_utils import pluralized
 from   commonpy.file_utils import filename_extension, filename_basename
-from   commonpy.file_utils import files_in_directory, readable, writable
+from   commonpy.file_utils import readable, writable
 from   commonpy.string_utils import antiformat
 import os
 from   os.path import isfile, isdir, exists
@@ -59,7 +59,8 @@ class MainBody(object):
         self._manager = Manager(self.services, self.threads, self.output_dir,
                                 self.make_grid, self.compare, self.extended,
                                 self.text_size, self.text_color, self.text_shift,
-                                self.display, self.confidence, self.reuse_json)
+                                self.display, self.confidence, self.reuse_json,
+                                self.use_cache, self.cache_dir)
 
 
     def run(self):
@@ -83,11 +84,6 @@ class MainBody(object):
     def _do_preflight(self):
         '''Check the option values given by the user, and do other prep.'''
 
-        from commonpy.network_utils import network_available
-        if not network_available():
-            alert_fatal('No network connection.')
-            raise CannotProceed(ExitCode.no_network)
-
         if self.from_file:
             if not exists(self.from_file):
                 alert_fatal(f'File not found: {self.from_file}')
@@ -129,15 +125,45 @@ class MainBody(object):
         import shutil
         print_separators = num_targets > 1
         rule = '─'*(shutil.get_terminal_size().columns or 80)
-        for index, item in enumerate(targets, start = 1):
-            # Check whether we've been interrupted before doing another item.
-            raise_for_interrupts()
-            # Process next item.
+        num_done = 0
+        try:
+            self._manager.prefetch(targets, self.base_name)
+            for index, item in enumerate(targets, start = 1):
+                # Check whether we've been interrupted before doing another item.
+                raise_for_interrupts()
+                # Process next item.
+                if print_separators:
+                    inform(rule)
+                if self._manager.run_services(item, index, self.base_name):
+                    num_done += 1
             if print_separators:
                 inform(rule)
-            self._manager.run_services(item, index, self.base_name)
-        if print_separators:
-            inform(rule)
+        except Exception as ex:
+            # Don't block on service calls that may still be running.
+            self._manager.shutdown(wait = False)
+            if not isinstance(ex, (CannotProceed, UserCancelled)):
+                self._check_network()
+            raise
+        except:
+            self._manager.shutdown(wait = False)
+            raise
+        self._manager.shutdown()
+
+        # Some failures (e.g., of downloads or of some services) are only
+        # reported as warnings.  If nothing worked at all, find out why.
+        if not num_done:
+            self._check_network()
+
+
+    def _check_network(self):
+        '''Raise CannotProceed if there is no network connection.'''
+        # We don't test for a network connection before starting, because
+        # that costs time on every run and isn't needed when results come
+        # from the cache.  Instead, this is called after things go wrong.
+        from commonpy.network_utils import network_available
+        if not network_available():
+            alert_fatal('No network connection.')
+            raise CannotProceed(ExitCode.no_network)
 
 
     def targets_from_arguments(self):
@@ -148,33 +174,69 @@ class MainBody(object):
         targets = []
         if self.from_file:
             if __debug__: log(f'reading {self.from_file}')
-            targets = filter(None, open(self.from_file).read().splitlines())
+            with open(self.from_file, 'r') as f:
+                targets = [line.strip() for line in f if line.strip()]
         else:
             for item in self.files:
                 if is_url(item):
                     targets.append(item)
-                elif isfile(item) and filename_extension(item) in ACCEPTED_FORMATS:
+                elif isfile(item) and item.lower().endswith(ACCEPTED_FORMATS):
                     targets.append(item)
                 elif isdir(item):
                     # It's a directory, so look for files within.
-                    targets += files_in_directory(item, extensions = ACCEPTED_FORMATS)
+                    targets += sorted(_image_files_in(item))
                 else:
                     warn(f'"{item}" not a file or directory')
 
         # Filter files created in past runs.
         targets = filter(lambda name: '.handprint' not in name, targets)
 
+        # Drop inputs given more than once (e.g., a file named explicitly and
+        # also found in a directory), keeping the first occurrence of each.
+        # Files are compared by absolute path so that "a.png" and "./a.png"
+        # count as the same.  Identical images under different names are
+        # not dropped here; they get their results from the cache instead.
+        # Note: the value of targets is an iterator, but b/c it's tested in
+        # the loop below, a separate list is needed (else get odd results).
+        targets = list(targets)
+        first = {}
+        for item in targets:
+            first.setdefault(item if is_url(item) else os.path.abspath(item), item)
+        unique = list(first.values())
+        if len(unique) < len(targets):
+            num_repeats = len(targets) - len(unique)
+            warn(f'Ignoring {pluralized("repeated input", num_repeats, True)}.')
+            targets = unique
+
         # If there is both a file in the format we generate and another
         # format of that file, ignore the other formats and just use ours.
-        # Note: the value of targets is an iterator, but b/c it's tested inside
-        # the loop, a separate list is needed (else get unexpected results).
-        targets = list(targets)
+        target_set = set(targets)
         keep = []
         for item in targets:
             ext  = filename_extension(item)
             base = filename_basename(item)
-            if ext != _OUTPUT_EXT and (base + _OUTPUT_EXT in targets):
+            if ext != _OUTPUT_EXT and (base + _OUTPUT_EXT in target_set):
                 # png version of file is also present => skip this other version
                 continue
             keep.append(item)
         return keep
+
+
+# Helper functions.
+# .............................................................................
+
+def _image_files_in(directory):
+    '''Yield the image files found in "directory" and its subdirectories.'''
+    # os.scandir() returns the type of each entry along with its name, so
+    # unlike os.listdir(), this doesn't need extra stat() calls per entry.
+    if __debug__: log(f'reading directory {directory}')
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield from _image_files_in(entry.path)
+                elif (entry.name.lower().endswith(ACCEPTED_FORMATS)
+                      and entry.is_file() and readable(entry.path)):
+                    yield entry.path
+    except OSError as ex:
+        if __debug__: log(f'unable to read {directory}: {ex}')
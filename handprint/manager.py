@@ -15,18 +15,21 @@ file "LICENSE" for more information.
 '''
 
 from   bun import inform, alert, warn
-from   collections import namedtuple
+from   collections import deque, namedtuple
 from   commonpy.interrupt import raise_for_interrupts, wait
 from   commonpy.file_utils import filename_basename, filename_extension, relative
-from   commonpy.file_utils import files_in_directory, alt_extension
+from   commonpy.file_utils import alt_extension
 from   commonpy.file_utils import readable, writable, nonempty
 from   commonpy.file_utils import delete_existing
-from   commonpy.network_utils import download_file
-from   concurrent.futures import ThreadPoolExecutor
+from   concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from   concurrent.futures import FIRST_EXCEPTION
+from   concurrent.futures import wait as wait_for_futures
+from   contextlib import closing
 import io
 from   itertools import repeat
 import json
 import math
+import multiprocessing
 import os
 from   os import path
 import shutil
@@ -34,25 +37,43 @@ import signal
 import sys
 import threading
 from   threading import Thread, Lock
-from   timeit import default_timer as timer
-import urllib
 
 # Note: additional imports are interspersed in the code below, to delay loading
 # packages until they're needed.  This speeds up initial application startup
 # time, although it goes against PEP 8 conventions.  IMHO it's worth it.
 import handprint
 from handprint import _OUTPUT_EXT, _OUTPUT_FORMAT
+from handprint.cpus import available_cpus
 from handprint.exceptions import *
-from handprint.services import KNOWN_SERVICES
+from handprint.ratelimit import RateLimiter
+from handprint.services import service_class
 
 if __debug__:
     from sidetrack import log
 
 
+# Internal constants.
+# .............................................................................
+
+# Number of attempts made to get a result from a service when it reports that
+# rate limits have been exceeded, and bounds (in seconds) on the exponential
+# backoff between attempts.
+_MAX_ATTEMPTS = 3
+_MIN_WAIT = 1
+_MAX_WAIT = 30
+
+# Maximum number of images downloaded ahead of time when inputs are URLs.
+_MAX_DOWNLOADS = 8
+
+# Maximum number of processes used to create results grids.  Each one holds
+# several full-size images in memory at once, so it's best not to go too high.
+_MAX_GRID_PROCESSES = 4
+
+
 # Helper data types.
 # .............................................................................
 
-Input = namedtuple('Input', 'item_source item_format item_file file dest_dir temp_files')
+Input = namedtuple('Input', 'item_source item_format item_file file dest_dir temp_files digest')
 Input.__doc__ = '''Input and related materials for a file sent to a service
   'item_source' is the original source, which may be a URL or a file
   'item_format' is the data or file format of the original source
@@ -60,6 +81,7 @@ Input.__doc__ = '''Input and related materials for a file sent to a service
   'file' is item_file after applying reductions
   'dest_dir' is the directory where normalized_file was written
   'temp_files' is a list of temporary files generated when creating normalized_file
+  'digest' is the hash of the content of 'file' used for cache keys, or None
 '''
 
 Result = namedtuple('Result', 'service original annotated report')
@@ -79,7 +101,8 @@ class Manager:
 
     def __init__(self, service_names, num_threads, output_dir, make_grid,
                  compare, extended, text_size, text_color, text_shift,
-                 display, confidence, reuse_json):
+                 display, confidence, reuse_json, use_cache = True,
+                 cache_dir = None):
         '''Initialize manager for services.  This will also initialize the
         credentials for individual services.
         '''
@@ -95,11 +118,23 @@ class Manager:
         self._confidence = confidence
         self._reuse_json = reuse_json
 
+        self._cache = None
+        if use_cache:
+            from handprint.cache import ResultCache
+            self._cache = ResultCache(cache_dir)
+        # Failures to write to the cache are only reported once.
+        self._cache_warned = False
+        self._cache_lock = Lock()
+
         self._services = []
+        self._limiters = {}
         for service_name in service_names:
-            service = KNOWN_SERVICES[service_name]()
+            service = service_class(service_name)()
             service.init_credentials()
             self._services.append(service)
+            # Calls to a given service are paced according to its stated
+            # maximum rate, across all the threads that may be using it.
+            self._limiters[service_name] = RateLimiter(service.max_rate())
 
         # In order to make the results comparable, we resize all the images
         # to the smallest size accepted by any of the services we will run.
@@ -122,17 +157,89 @@ class Manager:
         if __debug__: log(f'max_size = {self._max_size}')
         if __debug__: log(f'max_dimensions = {self._max_dimensions}')
 
+        # Images in a format that all the services accept are sent as-is.
+        # Anything else is converted to PNG, which all services accept.
+        self._formats = set.intersection(*(set(s.accepted_formats())
+                                           for s in self._services))
+        if __debug__: log(f'formats accepted by all services: {self._formats}')
+
         # An unfortunate feature of Python's thread handling is that threads
         # don't get interrupt signals: if the user hits ^C, the parent thread
         # has to do something to interrupt the child threads deliberately.
         # We can't do that unless we keep a pointer to the futures/subthreads.
         self._senders = []
 
+        # The same pool of threads is used for every input, rather than
+        # creating (and abandoning) a new pool each time.  For 1 thread, we
+        # avoid the thread pool to make debugging easier.
+        self._executor = None
+        if self._num_threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers = self._num_threads,
+                                                thread_name_prefix = 'ServiceThread')
+
+        # Downloads of URL inputs started ahead of time by prefetch(), indexed
+        # by the position of the input in the list of targets, and the URLs
+        # still waiting to be started.
+        self._downloader = None
+        self._downloads = {}
+        self._to_download = deque()
+
+        # URL inputs are fetched over a shared pool of kept-alive connections,
+        # so that several images from the same server don't each pay for a
+        # new connection.  The client is created when it's first needed.
+        self._http = None
+        self._http_lock = Lock()
+
+        # Creating the results grid for one input is done on a separate
+        # thread, so that the next input can be sent to the services in the
+        # meantime.  The futures are indexed by grid file name (see
+        # run_services(...) for why).  The grid images themselves are
+        # composited and encoded in separate processes, because that's
+        # CPU-bound work that would otherwise contend for the GIL with the
+        # threads talking to the services.
+        self._grid_workers = min(_MAX_GRID_PROCESSES, available_cpus())
+        self._grid_pool = None
+        if self._make_grid:
+            # Processes are only started when the first grid is submitted.
+            self._grid_pool = ProcessPoolExecutor(max_workers = self._grid_workers,
+                                                  mp_context = _grid_context())
+        self._finisher = ThreadPoolExecutor(max_workers = self._grid_workers,
+                                            thread_name_prefix = 'FinishThread')
+        self._finishing = {}
+
+
+    def prefetch(self, targets, base_name):
+        '''Start downloading the images for any URLs in "targets" in the
+        background, so that they are ready by the time run_services(...) gets
+        to them.  The arguments are the same as those later given to
+        run_services(...) for each item.
+        '''
+        from validator_collection.checkers import is_url
+        urls = [(index, item) for index, item in enumerate(targets, start = 1)
+                if is_url(item)]
+        if not urls:
+            return
+        if __debug__: log(f'prefetching {len(urls)} URLs')
+        self._downloader = ThreadPoolExecutor(max_workers = _MAX_DOWNLOADS,
+                                              thread_name_prefix = 'DownloadThread')
+        self._to_download = deque((index, item, base_name) for index, item in urls)
+        self._download_ahead()
+
+
+    def _download_ahead(self):
+        '''Start downloads until _MAX_DOWNLOADS are pending or done but unused.
+        This keeps a long list of URLs from all being downloaded up front.'''
+        while self._to_download and len(self._downloads) < _MAX_DOWNLOADS:
+            (index, item, base_name) = self._to_download.popleft()
+            self._downloads[index] = self._downloader.submit(self._download, item,
+                                                             base_name, index)
+
 
     def run_services(self, item, index, base_name):
         '''Run all requested services on the image indicated by "item", using
         "index" and "base_name" to construct a download copy of the item if
-        it has to be downloaded from a URL first.
+        it has to be downloaded from a URL first.  Returns True if at least
+        one of the services produced a result.
         '''
         # Shortcuts to make the code more readable.
         services = self._services
@@ -147,6 +254,16 @@ class Manager:
             alert(f'Cannot write output in {dest_dir}.')
             return
 
+        # Output files are named after the input file, so two inputs in the
+        # same directory whose names differ only in their extensions (e.g.,
+        # page1.tif and page1.gif) write the same files.  Finish the grid
+        # for the earlier one before starting on the later one.
+        base = path.basename(filename_basename(item_file))
+        grid_file = path.realpath(path.join(dest_dir, base + '.handprint-all.png'))
+        if grid_file in self._finishing:
+            if __debug__: log(f'waiting for earlier grid {grid_file}')
+            self._finishing.pop(grid_file).result()
+
         # Normalize input image to the lowest common denominator.
         image = self._normalized(item, item_fmt, item_file, dest_dir)
         if not image.file:
@@ -155,15 +272,23 @@ class Manager:
 
         # Send the file to the services and get Result tuples back.
         self._senders = []
-        if self._num_threads == 1:
-            # For 1 thread, avoid thread pool to make debugging easier.
+        if not self._executor:
             results = [self._send(image, s) for s in services]
         else:
-            executor = ThreadPoolExecutor(max_workers = self._num_threads,
-                                          thread_name_prefix = 'ServiceThread')
             for service in services:
-                future = executor.submit(self._send, image, service)
+                future = self._executor.submit(self._send, image, service)
                 self._senders.append(future)
+            # Block until all are done, unless one fails (e.g., because of an
+            # authentication error), in which case don't wait for the others.
+            (done, pending) = wait_for_futures(self._senders,
+                                               return_when = FIRST_EXCEPTION)
+            failed = [f for f in done if f.exception()]
+            if failed:
+                for future in pending:
+                    future.cancel()
+                raise failed[0].exception()
+            # Results are kept in the order of the services, not in the order
+            # they finished, so that the grid layout is always the same.
             results = [future.result() for future in self._senders]
 
         # If a service failed for some reason (e.g., a network glitch), we
@@ -173,19 +298,11 @@ class Manager:
             warn(f'Nothing to do for {item}')
             return
 
-        # Create grid file if requested.
-        if self._make_grid:
-            base = path.basename(filename_basename(item_file))
-            grid_file = path.realpath(path.join(dest_dir, base + '.handprint-all.png'))
-            inform(f'Creating results grid image: {relative(grid_file)}')
-            all_results = [r.annotated for r in results]
-            width = math.ceil(math.sqrt(len(all_results)))
-            from handprint.images import create_image_grid
-            create_image_grid(all_results, grid_file, max_horizontal = width)
-
-        # Clean up after ourselves.
+        # Clean up the temporary input files now, so that they can't be
+        # mistaken for files of the next input.
+        annotated = [r.annotated for r in results]
         if not self._extended_results:
-            for file in set(image.temp_files | {r.annotated for r in results}):
+            for file in image.temp_files - set(annotated):
                 if file and path.exists(file):
                     delete_existing(file)
         elif image.file != image.item_file:
@@ -195,7 +312,17 @@ class Manager:
             # sized image than if we sized it appropriately for _this_ run.
             delete_existing(image.file)
 
+        # Create the grid while the caller moves on to the next item.  The
+        # annotated images are needed for that, so they're deleted after it.
+        if self._make_grid:
+            inform(f'Creating results grid image: {relative(grid_file)}')
+            self._finishing[grid_file] = self._finisher.submit(self._finish,
+                                                               annotated, grid_file)
+        elif not self._extended_results:
+            self._delete_annotated(annotated)
+
         inform(f'Done with {relative(item)}')
+        return True
 
 
     def stop_services(self):
@@ -209,39 +336,83 @@ class Manager:
                 if __debug__: log(f'unable to cancel {s}')
 
 
-    def _get(self, item, base_name, index):
-        # Shortcuts to make the code more readable.
-        output_dir = self._output_dir
+    def shutdown(self, wait = True):
+        '''Release the thread pools after all inputs have been processed.
+        If "wait" is True, this also waits for the creation of results grids
+        to finish, and raises any exception that occurred while doing so.
+        '''
+        if self._finisher:
+            if __debug__: log('shutting down finisher thread pool')
+            if not wait:
+                for future in self._finishing.values():
+                    future.cancel()
+            self._finisher.shutdown(wait = wait)
+            self._finisher = None
+            if self._grid_pool:
+                self._grid_pool.shutdown(wait = wait)
+                self._grid_pool = None
+            if wait:
+                for future in self._finishing.values():
+                    future.result()
+            self._finishing = {}
+        if self._executor:
+            if __debug__: log('shutting down service thread pool')
+            self._executor.shutdown(wait = wait)
+            self._executor = None
+        if self._downloader:
+            if __debug__: log('shutting down download thread pool')
+            for future in self._downloads.values():
+                future.cancel()
+            self._downloads = {}
+            self._to_download = deque()
+            self._downloader.shutdown(wait = wait)
+            self._downloader = None
+        if self._http and wait:
+            if __debug__: log('closing HTTP client')
+            self._http.close()
+            self._http = None
+
+
+    def _finish(self, annotated, grid_file):
+        '''Create the results grid from the "annotated" images.'''
+        width = math.ceil(math.sqrt(len(annotated)))
+        self._grid_pool.submit(_grid, annotated, grid_file, width).result()
+        if not self._extended_results:
+            self._delete_annotated(annotated)
+
+
+    def _delete_annotated(self, annotated):
+        for file in annotated:
+            if file and path.exists(file):
+                delete_existing(file)
 
+
+    def _http_client(self):
+        '''Return the HTTP client used for URL inputs, creating it if needed.'''
+        with self._http_lock:
+            if not self._http:
+                import httpx
+                if __debug__: log('creating HTTP client for URL inputs')
+                timeout = httpx.Timeout(15, connect = 15, read = 15, write = 15)
+                self._http = httpx.Client(timeout = timeout, follow_redirects = True)
+        return self._http
+
+
+    def _get(self, item, base_name, index):
         # For URLs, we download the corresponding files and name them with
         # the base_name.
         from validator_collection.checkers import is_url
         if is_url(item):
-            # First make sure the URL actually points to an image.
-            if __debug__: log(f'testing if URL contains an image: {item}')
-            headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64)'}
-            try:
-                request = urllib.request.Request(item, None, headers)
-                response = urllib.request.urlopen(request)
-            except Exception as ex:
-                warn(f'Skipping URL due to error: {ex}')
-                return (None, None)
-            if response.headers.get_content_maintype() != 'image':
-                warn(f'Did not find an image at {item}')
-                return (None, None)
-            orig_fmt = response.headers.get_content_subtype()
-            base = f'{base_name}-{index}'
-            # If we weren't given an output dir, then for URLs, we have no
-            # choice but to use the current dir to download the file.
-            # Important: don't change self._output_dir because if other
-            # inputs *are* files, then those files will need other output dirs.
-            if not output_dir:
-                output_dir = os.getcwd()
-            file = path.realpath(path.join(output_dir, base + '.' + orig_fmt))
-            if not download_file(item, file):
-                warn(f'Unable to download {item}')
+            if index in self._downloads:
+                future = self._downloads.pop(index)
+                self._download_ahead()
+                (file, orig_fmt, error) = future.result()
+            else:
+                (file, orig_fmt, error) = self._download(item, base_name, index)
+            if error:
+                warn(error)
                 return (None, None)
-            url_file = path.realpath(path.join(output_dir, base + '.url'))
+            url_file = alt_extension(file, 'url')
             with open(url_file, 'w') as f:
                 f.write(url_file_content(item))
                 inform(f'Wrote URL to [white on grey42]{relative(url_file)}[/]')
@@ -257,6 +428,52 @@ class Manager:
         return (file, orig_fmt)
 
 
+    def _download(self, item, base_name, index):
+        '''Download the image at URL "item".  Returns a tuple of the file,
+        its format, and an error message (None if there was no problem).
+        This may run on a separate thread, so it doesn't print anything.'''
+        # Shortcuts to make the code more readable.
+        output_dir = self._output_dir
+
+        # First make sure the URL actually points to an image.
+        if __debug__: log(f'testing if URL contains an image: {item}')
+        headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64)'}
+        client = self._http_client()
+        try:
+            request = client.build_request('GET', item, headers = headers)
+            response = client.send(request, stream = True)
+        except Exception as ex:
+            return (None, None, f'Skipping URL due to error: {ex}')
+        # The same response is used to check the type and to download the
+        # content, so that the server is only contacted once.
+        with closing(response):
+            if response.is_error:
+                return (None, None, f'Skipping URL due to error: HTTP {response.status_code}')
+            content_type = response.headers.get('content-type', '')
+            (maintype, _, orig_fmt) = content_type.split(';')[0].partition('/')
+            orig_fmt = orig_fmt.strip().lower()
+            if maintype.strip().lower() != 'image' or not orig_fmt:
+                return (None, None, f'Did not find an image at {item}')
+            base = f'{base_name}-{index}'
+            # If we weren't given an output dir, then for URLs, we have no
+            # choice but to use the current dir to download the file.
+            # Important: don't change self._output_dir because if other
+            # inputs *are* files, those files will need other output dirs.
+            if not output_dir:
+                output_dir = os.getcwd()
+            file = path.realpath(path.join(output_dir, base + '.' + orig_fmt))
+            try:
+                with open(file, 'wb') as f:
+                    for chunk in response.iter_bytes():
+                        f.write(chunk)
+            except Exception as ex:
+                if __debug__: log(f'download exception: {ex}')
+                if path.exists(file):
+                    os.unlink(file)
+                return (None, None, f'Unable to download {item}')
+        return (file, orig_fmt, None)
+
+
     # The following thread lock is used in _send(...) around a call to creating
     # an annotated image of the results from a service.  The annotation
     # function in question uses image functions from matplotlib, and during
@@ -278,25 +495,40 @@ class Manager:
         json_file    = self._renamed(base_path, str(service), 'json')
 
         saved_results = None
+        cache_key = cached_results = None
         if self._reuse_json and readable(json_file):
             inform(f'Reading saved results for {service_name} from {relative(json_file)}')
             with open(json_file, 'r') as f:
                 saved_results = json.load(f)
             output = service.result(image.file, saved_results)
-        else:
-            inform(f'Sending to {service_name} and waiting for response ...')
-            last_time = timer()
-            try:
-                output = service.result(image.file, None)
-            except AuthFailure as ex:
-                raise AuthFailure(f'Service {service}: {str(ex)}')
-            except RateLimitExceeded as ex:
-                time_passed = timer() - last_time
-                if time_passed < 1/service.max_rate():
-                    warn(f'Pausing {service_name} due to rate limits')
-                    wait(1/service.max_rate() - time_passed)
-                    warn(f'Continuing {service_name}')
-                    return self._send(image, service)
+        elif self._cache:
+            cache_key = self._cache.key(image.file, str(service), image.digest)
+            cached_results = self._cache.get(cache_key)
+
+        if cached_results is not None:
+            inform(f'Using cached results for {service_name}.')
+            output = service.result(image.file, cached_results)
+        elif saved_results is None:
+            output = None
+            for attempt in range(_MAX_ATTEMPTS):
+                self._limiters[str(service)].acquire()
+                inform(f'Sending to {service_name} and waiting for response ...')
+                try:
+                    output = service.result(image.file, None)
+                    break
+                except AuthFailure as ex:
+                    raise AuthFailure(f'Service {service}: {str(ex)}')
+                except RateLimitExceeded as ex:
+                    if attempt + 1 == _MAX_ATTEMPTS:
+                        break
+                    pause = min(_MAX_WAIT, _MIN_WAIT * 2**attempt)
+                    warn(f'Pausing {service_name} for {pause} s due to rate limits')
+                    wait(pause)
+            if not output:
+                alert(f'{service_name} rate limit still exceeded after'
+                      f' {_MAX_ATTEMPTS} attempts')
+                warn(f'No result from {service_name} for {relative(image.file)}')
+                return None
             if output.error:
                 # Sanitize the error string in case it contains '{' characters.
                 msg = output.error.replace('{', '{{{{').replace('}', '}}}}')
@@ -304,6 +536,11 @@ class Manager:
                 warn(f'No result from {service_name} for {relative(image.file)}')
                 return None
             inform(f'Got result from {service_name}.')
+            if cache_key and not self._cache.set(cache_key, output.data):
+                with self._cache_lock:
+                    if not self._cache_warned:
+                        warn(f'Unable to save results in {self._cache.cache_dir}')
+                        self._cache_warned = True
 
         raise_for_interrupts()
         inform(f'Creating annotated image for {service_name}.')
@@ -311,10 +548,10 @@ class Manager:
         report_path = None
         from handprint.images import annotated_image
         with self._lock:
-            img = annotated_image(image.file, output.boxes, service,
-                                  self._text_size, self._text_color, self._text_shift,
-                                  self._display, self._confidence)
-            self._save(img, annot_path)
+            if __debug__: log(f'writing output to file {relative(annot_path)}')
+            annotated_image(image.file, output.boxes, service, annot_path,
+                            self._text_size, self._text_color, self._text_shift,
+                            self._display, self._confidence)
 
         if self._extended_results and (saved_results is None):
             inform(f'Saving all data for {service_name}.')
@@ -345,9 +582,13 @@ class Manager:
         '''Normalize images to same format and max size.'''
         to_delete = set()
 
-        # All services accept PNG, so normalize files to PNG.
+        # Use the original format if all the services accept it; otherwise,
+        # convert to PNG, which all services accept.  Re-encoding a JPEG file
+        # as PNG is slow and typically makes the file several times larger.
+        from handprint.images import canonical_format_name, exif_rotated
         file = item_file
-        if orig_fmt != _OUTPUT_FORMAT:
+        if (canonical_format_name(orig_fmt) not in self._formats
+            or exif_rotated(file)):
             new_file = self._converted_file(file, _OUTPUT_FORMAT, dest_dir)
             if new_file and path.basename(new_file) != path.basename(file):
                 to_delete.add(new_file)
@@ -371,7 +612,9 @@ class Manager:
                 to_delete.add(new_file)
             file = new_file
 
-        return Input(orig_item, orig_fmt, item_file, file, dest_dir, to_delete)
+        # The hash is computed here, once, rather than for every service.
+        digest = self._cache.digest(file) if (file and self._cache) else None
+        return Input(orig_item, orig_fmt, item_file, file, dest_dir, to_delete, digest)
 
 
     def _converted_file(self, file, to_format, dest_dir):
@@ -383,7 +626,10 @@ class Manager:
         else:
             inform(f'Converting to {to_format} format: {relative(file)}')
             from handprint.images import converted_image
-            (converted, error) = converted_image(file, to_format, new_file)
+            # Reduce the dimensions at the same time, if needed.  This saves
+            # decoding and encoding the image again in _resized_image().
+            (converted, error) = converted_image(file, to_format, new_file,
+                                                 self._max_dimensions)
             if error:
                 alert(f'Failed to convert {relative(file)}: {error}')
                 return None
@@ -480,3 +726,24 @@ class Manager:
 
 def url_file_content(url):
     return f'[InternetShortcut]\nURL={url}\n'
+
+
+def _grid(image_files, dest_file, width):
+    '''Create a grid image from "image_files".  This runs in a subprocess, so
+    unlike create_image_grid(...), it doesn't return the image itself.'''
+    from handprint.images import create_image_grid
+    create_image_grid(image_files, dest_file, max_horizontal = width)
+
+
+def _grid_context():
+    '''Return the multiprocessing context for the grid processes.'''
+    # Forking this process is unsafe because other threads are running in it
+    # (e.g., one may hold a lock that would then never be released in the
+    # child).  Where possible, the workers are instead forked from a separate
+    # server process that starts out clean.  It imports the image code once,
+    # so that each new worker doesn't have to.  Windows only supports spawn.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['handprint.images'])
+        return context
+    return multiprocessing.get_context('spawn')
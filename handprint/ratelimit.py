@@ -0,0 +1,54 @@
+'''
+ratelimit.py: pace calls to network services
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2018-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   commonpy.interrupt import wait
+from   threading import Lock
+from   time import monotonic
+
+if __debug__:
+    from sidetrack import log
+
+
+# Exported classes.
+# .............................................................................
+
+class RateLimiter():
+    '''Enforce a minimum interval between successive calls to a service.
+
+    A single RateLimiter object is meant to be shared by all the threads that
+    send requests to a given service.  Each call to acquire() reserves the
+    next available time slot and then waits (interruptibly) until it arrives.
+    '''
+
+    def __init__(self, max_rate):
+        '''Create a limiter allowing at most "max_rate" calls per second.
+        A value of None or 0 means no limit.'''
+        self._interval = 1/max_rate if max_rate else 0
+        self._next_slot = 0
+        self._lock = Lock()
+
+
+    def acquire(self):
+        '''Wait until the next call to the service is allowed.'''
+        if not self._interval:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            if __debug__: log(f'rate limiter pausing for {slot - now:.2f} s')
+            wait(slot - now)
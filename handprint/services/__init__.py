@@ -14,18 +14,20 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from .amazon import AmazonRekognitionTR, AmazonTextractTR
-from .google import GoogleTR
-from .microsoft import MicrosoftTR
+from importlib import import_module
 
 ACCEPTED_FORMATS = ('.jpg', '.jpeg', '.jp2', '.pdf', '.png', '.gif', '.bmp',
                     '.tif', '.tiff')
 
+# The modules implementing the services are only imported when a service is
+# actually used, so that things like "handprint -l" don't pay for loading the
+# code (and dependencies) of every service.  The values in this dictionary
+# are (module name, class name) for each service.
 KNOWN_SERVICES = {
-    'amazon-rekognition': AmazonRekognitionTR,
-    'amazon-textract': AmazonTextractTR,
-    'google': GoogleTR,
-    'microsoft': MicrosoftTR,
+    'amazon-rekognition': ('amazon', 'AmazonRekognitionTR'),
+    'amazon-textract': ('amazon', 'AmazonTextractTR'),
+    'google': ('google', 'GoogleTR'),
+    'microsoft': ('microsoft', 'MicrosoftTR'),
 }
 
 # Save this list to avoid recreating it all the time.
@@ -33,3 +35,10 @@ SERVICES_LIST = sorted(KNOWN_SERVICES.keys())
 
 def services_list():
     return SERVICES_LIST
+
+
+def service_class(name):
+    '''Return the class implementing the service called "name".'''
+    (module_name, class_name) = KNOWN_SERVICES[name]
+    module = import_module(f'handprint.services.{module_name}')
+    return getattr(module, class_name)
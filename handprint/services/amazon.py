@@ -19,6 +19,7 @@ from   commonpy.interrupt import raise_for_interrupts
 import imagesize
 import os
 import sys
+from   threading import Lock
 
 if __debug__:
     from sidetrack import log
@@ -35,6 +36,14 @@ from handprint.services.base import TextRecognition, TRResult, Box
 class AmazonTR(TextRecognition):
     '''Base class for Amazon text recognition services.'''
 
+    # Creating a boto3 client is slow (it loads the service model from disk)
+    # and each client keeps its own pool of HTTPS connections, so each service
+    # creates its client once and reuses it for every image.  (Clients are
+    # thread-safe; sessions are not, which is why only the client is shared.)
+    _client = None
+    _client_lock = Lock()
+
+
     def init_credentials(self):
         '''Initializes the credentials to use for accessing this service.'''
         try:
@@ -63,6 +72,27 @@ class AmazonTR(TextRecognition):
         return None
 
 
+    def accepted_formats(self):
+        '''Returns the image formats accepted by the service, as a tuple of
+        canonical format names (see images.canonical_format_name()).'''
+        # The synchronous Textract and Rekognition APIs take JPEG and PNG.
+        return ('jpeg', 'png')
+
+
+    def _client_for(self, variant):
+        '''Return the boto3 client for "variant", creating it if needed.'''
+        with self._client_lock:
+            if not self._client:
+                import boto3
+                if __debug__: log(f'setting up Amazon client function "{variant}"')
+                creds = self._credentials
+                session = boto3.session.Session()
+                self._client = session.client(variant, region_name = creds['region_name'],
+                                              aws_access_key_id = creds['aws_access_key_id'],
+                                              aws_secret_access_key = creds['aws_secret_access_key'])
+        return self._client
+
+
     # General scheme of things:
     #
     # * Return errors (via TRResult) if a result could not be obtained
@@ -86,7 +116,6 @@ class AmazonTR(TextRecognition):
 
         # Delay loading the API packages until needed because they take time to
         # load.  Doing this speeds up overall application start time.
-        import boto3
         import botocore
 
         if not result:
@@ -96,12 +125,7 @@ class AmazonTR(TextRecognition):
                 return TRResult(path = file_path, data = {}, boxes = [],
                                 text = '', error = error)
             try:
-                if __debug__: log(f'setting up Amazon client function "{variant}"')
-                creds = self._credentials
-                session = boto3.session.Session()
-                client = session.client(variant, region_name = creds['region_name'],
-                                        aws_access_key_id = creds['aws_access_key_id'],
-                                        aws_secret_access_key = creds['aws_secret_access_key'])
+                client = self._client_for(variant)
                 if __debug__: log('calling Amazon API function')
                 result = getattr(client, method)( **{ image_keyword : {'Bytes': image} })
                 if __debug__: log(f'received {len(result[result_key])} blocks')
@@ -123,6 +147,9 @@ class AmazonTR(TextRecognition):
                         raise CorruptedContent(msg)
                     elif code in ['InvalidSignatureException', 'UnrecognizedClientException']:
                         raise AuthFailure(f'Problem with credentials file -- {text}')
+                    elif code in ['ThrottlingException', 'LimitExceededException',
+                                  'ProvisionedThroughputExceededException']:
+                        raise RateLimitExceeded(f'Amazon {variant} rate limit exceeded -- {text}')
                 # Fallback if we can't get details.
                 if __debug__: log(f'Amazon returned exception {str(ex)}')
                 msg = f'Amazon {variant} failure for {path} -- {error["Message"]}'
@@ -129,6 +129,12 @@ class TextRecognition(object):
         pass
 
 
+    def accepted_formats(self):
+        '''Returns the image formats accepted by the service, as a tuple of
+        canonical format names (see images.canonical_format_name()).'''
+        return ('png',)
+
+
     def result(self, path, saved_result = None):
         '''Returns the text recognition results from the service as an
         TRResult named tuple.  If a saved result is supplied, use that.
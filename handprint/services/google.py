@@ -21,6 +21,7 @@ import json
 import math
 import os
 import json
+from   threading import Lock
 
 if __debug__:
     from sidetrack import log
@@ -40,6 +41,12 @@ class GoogleTR(TextRecognition):
     # as of 2018-10-25.
     _known_features = ['document_text_detection']
 
+    # Creating an ImageAnnotatorClient loads the credentials and opens a gRPC
+    # channel, so it's done once and the client is reused for every image.
+    # (The client is thread-safe.)
+    _client = None
+    _client_lock = Lock()
+
 
     def init_credentials(self):
         '''Initializes the credentials to use for accessing this service.'''
@@ -85,6 +92,25 @@ class GoogleTR(TextRecognition):
         return None
 
 
+    def accepted_formats(self):
+        '''Returns the image formats accepted by the service, as a tuple of
+        canonical format names (see images.canonical_format_name()).'''
+        # https://cloud.google.com/vision/docs/supported-files
+        # Google also takes PDF and TIFF, but those can have multiple pages,
+        # and we only handle the first one.
+        return ('bmp', 'gif', 'jpeg', 'png')
+
+
+    def _annotator(self):
+        '''Return the Google client object, creating it if needed.'''
+        with self._client_lock:
+            if not self._client:
+                from google.cloud import vision_v1 as gv
+                if __debug__: log('creating Google ImageAnnotatorClient')
+                self._client = gv.ImageAnnotatorClient()
+        return self._client
+
+
     # General scheme of things:
     #
     # * Return errors (via TRResult) if a result could not be obtained
@@ -120,7 +146,7 @@ class GoogleTR(TextRecognition):
 
             if __debug__: log(f'building Google API object for {relative(path)}')
             try:
-                client  = gv.ImageAnnotatorClient()
+                client  = self._annotator()
                 params  = gv.TextDetectionParams(
                     mapping = { 'enable_text_detection_confidence_score': True })
                 context = gv.ImageContext(language_hints = ['en-t-i0-handwrit'],
@@ -137,6 +163,9 @@ class GoogleTR(TextRecognition):
             except google.auth.exceptions.DefaultCredentialsError as ex:
                 text = 'Credentials file error for Google service -- {}'.format(ex)
                 raise AuthFailure(text)
+            except google.api_core.exceptions.ResourceExhausted as ex:
+                text = 'Google rate limit or quota exceeded -- {}'.format(ex)
+                raise RateLimitExceeded(text)
             except google.api_core.exceptions.ServiceUnavailable as ex:
                 text = 'Network, service, or Google configuration error -- {}'.format(ex)
                 raise ServiceFailure(text)
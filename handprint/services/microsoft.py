@@ -22,6 +22,7 @@ from   commonpy.file_utils import relative
 import json
 import os
 import sys
+from   threading import Lock
 
 if __debug__:
     from sidetrack import log
@@ -37,6 +38,14 @@ from handprint.services.base import TextRecognition, TRResult, Box
 
 class MicrosoftTR(TextRecognition):
 
+    # Each image takes several requests (one to submit it, then one every 2 s
+    # while polling for the result).  They all go through one HTTP client so
+    # that its connection to the server is reused rather than set up anew
+    # for every request.
+    _client = None
+    _client_lock = Lock()
+
+
     def init_credentials(self):
         '''Initializes the credentials to use for accessing this service.'''
         try:
@@ -80,6 +89,14 @@ class MicrosoftTR(TextRecognition):
         return (10000, 10000)
 
 
+    def accepted_formats(self):
+        '''Returns the image formats accepted by the service, as a tuple of
+        canonical format names (see images.canonical_format_name()).'''
+        # The Read API also takes PDF and TIFF, but those can have multiple
+        # pages, and we only handle the first one.
+        return ('bmp', 'jpeg', 'png')
+
+
     # General scheme of things:
     #
     # * Return errors (via TRResult) if a result could not be obtained
@@ -201,11 +218,25 @@ class MicrosoftTR(TextRecognition):
         return analysis
 
 
+    def _http_client(self):
+        '''Return the HTTP client object, creating it if needed.'''
+        with self._client_lock:
+            if not self._client:
+                import httpx
+                if __debug__: log('creating HTTP client for Microsoft')
+                # Same settings as net() uses when it's not given a client.
+                timeout = httpx.Timeout(15, connect = 15, read = 15, write = 15)
+                self._client = httpx.Client(timeout = timeout, http2 = True,
+                                            verify = False)
+        return self._client
+
+
     def _api(self, method, url, headers, data = None, polling = False):
         from commonpy.network_utils import net
         from functools import partial
 
-        net_call = partial(net, method, url, headers = headers, polling = polling)
+        net_call = partial(net, method, url, client = self._http_client(),
+                           headers = headers, polling = polling)
         if method == 'post':
             response, error = net_call(data = data)
         else:
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from handprint.cache import ResultCache
+
+
+def test_cache_roundtrip():
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    image = os.path.join(thisdir, 'data', 'fragments', 'f1.png')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ResultCache(os.path.join(tmpdir, 'cache'))
+        key = cache.key(image, 'google')
+        assert key == cache.key(image, 'google')
+        assert key != cache.key(image, 'microsoft')
+        assert cache.get(key) is None
+        cache.set(key, {'text': 'hello', 'boxes': [1, 2, 3]})
+        assert cache.get(key) == {'text': 'hello', 'boxes': [1, 2, 3]}
+        cache.clear()
+        assert cache.get(key) is None
+
+
+def test_cache_clear_leaves_other_files():
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    image = os.path.join(thisdir, 'data', 'fragments', 'f1.png')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ResultCache(tmpdir)
+        key = cache.key(image, 'google')
+        cache.set(key, {'text': 'hello'})
+        other_file = os.path.join(tmpdir, 'notes.json')
+        other_dir = os.path.join(tmpdir, 'data')
+        os.mkdir(other_dir)
+        for name in [other_file, os.path.join(other_dir, 'results.json')]:
+            with open(name, 'w') as f:
+                f.write('{}')
+        cache.clear()
+        assert cache.get(key) is None
+        assert not os.path.exists(os.path.join(tmpdir, 'google'))
+        assert os.path.exists(other_file)
+        assert os.path.exists(os.path.join(other_dir, 'results.json'))
+
+
+def test_cache_expiration():
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    image = os.path.join(thisdir, 'data', 'fragments', 'f1.png')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ResultCache(os.path.join(tmpdir, 'cache'), max_age = 60)
+        key = cache.key(image, 'google')
+        cache.set(key, {'text': 'hello'})
+        assert cache.get(key) == {'text': 'hello'}
+        cached_file = cache._path(key)
+        old = os.path.getmtime(cached_file) - 120
+        os.utime(cached_file, (old, old))
+        assert cache.get(key) is None
+        assert not os.path.exists(cached_file)
+
+
+def test_cache_set_failure():
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    image = os.path.join(thisdir, 'data', 'fragments', 'f1.png')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # A directory can't be created inside a regular file.
+        not_a_dir = os.path.join(tmpdir, 'file')
+        with open(not_a_dir, 'w') as f:
+            f.write('')
+        cache = ResultCache(os.path.join(not_a_dir, 'cache'))
+        key = cache.key(image, 'google')
+        assert cache.set(key, {'text': 'hello'}) is False
+        assert cache.get(key) is None
+
+
+def test_cache_key_from_digest():
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    image = os.path.join(thisdir, 'data', 'fragments', 'f1.png')
+    other = os.path.join(thisdir, 'data', 'fragments', 'f2.png')
+    cache = ResultCache()
+    digest = cache.digest(image)
+    assert cache.key(image, 'google', digest) == cache.key(image, 'google')
+    assert cache.key(other, 'google', digest) == cache.key(image, 'google')
+    assert cache.key(image, 'google', digest) != cache.key(image, 'microsoft', digest)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from handprint.cpus import available_cpus
+
+
+def test_available_cpus():
+    count = available_cpus()
+    assert isinstance(count, int)
+    assert 1 <= count <= (os.cpu_count() or 1)
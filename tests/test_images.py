@@ -63,3 +63,45 @@ def test_converted_image():
     assert isinstance(a, str)
     assert b is None
     delete_existing(tmpfile)
+
+
+def test_converted_image_with_max_dimensions():
+    _, tmpfile = tempfile.mkstemp(dir = '/tmp', suffix = '.tiff')
+    thisdir = path.dirname(os.path.abspath(__file__))
+    f1_file = path.join(thisdir, 'data', 'fragments', 'f1.png')
+    (a, b) = converted_image(f1_file, 'tif', tmpfile, (100, 100))
+    assert isinstance(a, str)
+    assert b is None
+    assert image_dimensions(tmpfile) == (100, 31)
+    (a, b) = converted_image(f1_file, 'tif', tmpfile, (1000, 1000))
+    assert image_dimensions(tmpfile) == (340, 106)
+    delete_existing(tmpfile)
+
+
+def test_exif_rotated():
+    thisdir = path.dirname(os.path.abspath(__file__))
+    assert not exif_rotated(path.join(thisdir, 'data', 'fragments', 'f1.png'))
+    _, tmpfile = tempfile.mkstemp(dir = '/tmp', suffix = '.jpg')
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new('RGB', (10, 20)).save(tmpfile, 'jpeg', exif = exif)
+    assert exif_rotated(tmpfile)
+    delete_existing(tmpfile)
+
+
+def test_annotated_image_16_bit():
+    class Service():
+        def name(self):
+            return 'test'
+    _, infile = tempfile.mkstemp(dir = '/tmp', suffix = '.png')
+    _, outfile = tempfile.mkstemp(dir = '/tmp', suffix = '.png')
+    # A 16-bit grayscale gradient from black to white.
+    gradient = np.tile(np.linspace(0, 65535, 200).astype(np.uint16), (100, 1))
+    Image.fromarray(gradient).save(infile)
+    assert Image.open(infile).mode == 'I;16'
+    annotated_image(infile, [], Service(), outfile)
+    pixels = np.asarray(Image.open(outfile).convert('L'))
+    # If the values were clipped to 8 bits, almost the whole image is white.
+    assert np.mean(pixels == 255) < 0.5
+    delete_existing(infile)
+    delete_existing(outfile)
@@ -0,0 +1,59 @@
+import os
+import sys
+from   unittest import mock
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from handprint.exceptions import CannotProceed, NetworkFailure
+from handprint.exit_codes import ExitCode
+from handprint.main_body import MainBody
+
+
+def run_main_body(manager, network):
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    image = os.path.join(thisdir, 'data', 'fragments', 'f1.png')
+    with mock.patch('handprint.manager.Manager', return_value = manager), \
+         mock.patch('commonpy.network_utils.network_available', return_value = network), \
+         mock.patch('handprint.main_body.inform'), \
+         mock.patch('handprint.main_body.warn'), \
+         mock.patch('handprint.main_body.alert_fatal'):
+        body = MainBody(services = ['microsoft'], threads = 1, output_dir = None,
+                        make_grid = False, compare = False, extended = False,
+                        text_size = 12, text_color = 'red', text_shift = (0, 0),
+                        display = ['text'], confidence = 0, reuse_json = False,
+                        use_cache = False, cache_dir = None, from_file = None,
+                        files = [image], base_name = 'document')
+        body.run()
+    return body.exception
+
+
+def test_all_failed_offline():
+    manager = mock.Mock()
+    manager.run_services.return_value = None
+    exception = run_main_body(manager, network = False)
+    assert exception[0] == CannotProceed
+    assert exception[1].args[0] == ExitCode.no_network
+
+
+def test_all_failed_online():
+    manager = mock.Mock()
+    manager.run_services.return_value = None
+    assert run_main_body(manager, network = True) is None
+
+
+def test_exception_offline():
+    manager = mock.Mock()
+    manager.run_services.side_effect = NetworkFailure('timed out')
+    exception = run_main_body(manager, network = False)
+    assert exception[0] == CannotProceed
+    assert exception[1].args[0] == ExitCode.no_network
+
+
+def test_success_offline():
+    manager = mock.Mock()
+    manager.run_services.return_value = True
+    assert run_main_body(manager, network = False) is None
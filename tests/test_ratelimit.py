@@ -0,0 +1,28 @@
+import os
+import sys
+from   time import monotonic
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from handprint.ratelimit import RateLimiter
+
+
+def test_no_limit():
+    limiter = RateLimiter(None)
+    start = monotonic()
+    for _ in range(100):
+        limiter.acquire()
+    assert monotonic() - start < 0.5
+
+
+def test_interval():
+    limiter = RateLimiter(20)
+    start = monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    # The first call goes through at once; the other 4 are spaced 0.05 s apart.
+    assert monotonic() - start >= 0.19